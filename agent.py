@@ -1,83 +1,389 @@
+import asyncio
 import json
 import os
+import sys
+import time
+from collections import OrderedDict
+from operator import attrgetter
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
 
+import httpx
+import numpy as np
 from dotenv import load_dotenv
 from morphik import Morphik
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from tools import build_tools, run_tool_call
+from tools import (
+    DEFAULT_RETRIEVE_K,
+    RawJSON,
+    arun_tool_call,
+    build_tools,
+    embed_query,
+    normalize_query,
+)
+
+try:
+    import orjson
+except ImportError:  # no native wheel for this platform
+    orjson = None
 
 load_dotenv()
 
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Morphik has no http_client argument, so swap its private httpx session for a
+# pooled keep-alive one. Tool calls reach it from worker threads.
 morphik = Morphik(uri=os.getenv("MORPHIK_URI"))
-openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+morphik._client.close()
+morphik._client = httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+openai = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT),
+)
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1")
+# Upper bound on tool-calling turns per query; the turn after the last one is
+# sent with tool_choice="none" so the model has to answer.
+MAX_TOOL_TURNS = 10
+SPECULATIVE_RETRIEVE_K = 4
+# Opt-in: race the first turn under different planning hints and keep the
+# fastest. Costs an extra model call per query.
+PARALLEL_BRANCHES = os.getenv("PARALLEL_BRANCHES", "").lower() in ("1", "true", "yes")
+BRANCH_HINTS = (
+    "Prefer calling retrieve_chunks first.",
+    "Prefer calling list_documents first.",
+)
+# Final answers from earlier runs, reused for repeated or near-identical queries.
+QUERY_CACHE_PATH = Path.home() / ".cache" / "morphik-agent" / "queries.json"
+QUERY_CACHE_MAXSIZE = 64
+QUERY_CACHE_MIN_SIMILARITY = 0.97
+# Answers don't track document changes, so they are only reused for an hour.
+QUERY_CACHE_TTL = 3600.0
 SYSTEM_INSTRUCTIONS = (
     "You are a helpful assistant with access to Morphik retrieval tools and the "
     "built-in code interpreter. Use retrieve_chunks for semantic search, "
     "get_page_range for page/chunk ranges, list_documents to browse documents, "
     "and load_file_for_execution to load files for Python analysis. After loading "
-    "a file, use its returned filename in the code interpreter."
+    "a file, use its returned filename in the code interpreter. Long chunk content "
+    "is truncated; call get_full_chunk_content when you need all of it. When you "
+    "need multiple independent facts, emit all tool calls in one turn."
 )
 
 
+def _json_default(value: object) -> object:
+    if isinstance(value, RawJSON):
+        if orjson is not None:
+            return orjson.Fragment(value.json)
+        return json.loads(value.json)
+    return str(value)
+
+
 def _json_dumps(value: object) -> str:
-    return json.dumps(value, default=str, ensure_ascii=True)
+    if isinstance(value, RawJSON):
+        return value.json
+    if orjson is not None:
+        return orjson.dumps(
+            value,
+            default=_json_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS,
+        ).decode()
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def _json_loads(raw: str) -> object:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+_item_type = attrgetter("type")
 
 
 def _collect_function_calls(response) -> list:
-    return [item for item in response.output if item.type == "function_call"]
+    output = response.output
+    if not output:
+        return []
+    return [item for item in output if _item_type(item) == "function_call"]
+
+
+async def _stream_response(
+    on_delta: Optional[Callable[[str], None]],
+    instructions: str = SYSTEM_INSTRUCTIONS,
+    tool_choice: str = "auto",
+    **kwargs,
+):
+    async with openai.responses.stream(
+        model=MODEL,
+        instructions=instructions,
+        parallel_tool_calls=True,
+        tool_choice=tool_choice,
+        store=True,
+        **kwargs,
+    ) as stream:
+        streamed = False
+        async for event in stream:
+            if event.type == "response.output_text.delta" and on_delta is not None:
+                on_delta(event.delta)
+                streamed = True
+        response = await stream.get_final_response()
+
+    # A turn can open with text ("Let me check...") before calling tools. It was
+    # shown live, but it isn't the answer: close it off from what follows.
+    if streamed and _collect_function_calls(response):
+        on_delta("\n\n")
+    return response
+
+
+async def _dispatch(call, state: dict) -> dict:
+    try:
+        args = _json_loads(call.arguments or "{}")
+    except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses this
+        args = {}
+    try:
+        result = await arun_tool_call(
+            call.name,
+            args,
+            morphik=morphik,
+            openai_client=openai,
+            state=state,
+        )
+        output = _json_dumps(result)
+    except Exception as exc:
+        output = _json_dumps({"error": str(exc)})
+
+    return {
+        "type": "function_call_output",
+        "call_id": call.call_id,
+        "output": output,
+    }
+
+
+async def _first_response(query: str, state: dict, on_delta: Optional[Callable[[str], None]]):
+    request = {
+        "input": [{"role": "user", "content": query}],
+        "tools": build_tools(state["file_ids"]),
+    }
+    if not PARALLEL_BRANCHES:
+        return await _stream_response(on_delta, **request)
+
+    # Branches don't stream: only the winner's text should reach on_delta.
+    pending = {
+        asyncio.create_task(_stream_response(None, instructions=f"{SYSTEM_INSTRUCTIONS} {hint}", **request))
+        for hint in BRANCH_HINTS
+    }
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    response = task.result()
+                    if on_delta is not None and not _collect_function_calls(response):
+                        on_delta(response.output_text)
+                    return response
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise error
+
+
+async def _speculate_retrieve(query: str, state: dict) -> None:
+    try:
+        await arun_tool_call(
+            "retrieve_chunks",
+            {"query": query, "k": SPECULATIVE_RETRIEVE_K},
+            morphik=morphik,
+            openai_client=openai,
+            state=state,
+        )
+    except Exception:
+        pass
+
 
+def _can_use_speculation(call) -> bool:
+    # The retrieve cache only serves entries with the same k, so waiting on the
+    # prefetch is pointless for any other k.
+    if call.name != "retrieve_chunks":
+        return False
+    try:
+        args = _json_loads(call.arguments or "{}")
+        return int(args.get("k") or DEFAULT_RETRIEVE_K) == SPECULATIVE_RETRIEVE_K
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        return False
 
-def run_agent(query: str) -> str:
+
+async def run_agent(
+    query: str,
+    on_delta: Optional[Callable[[str], None]] = None,
+    query_embedding: "Union[np.ndarray, asyncio.Future[Optional[np.ndarray]], None]" = None,
+) -> str:
     state = {"file_ids": set(), "loaded_files": {}}
+    if query_embedding is not None:
+        state["query_embeddings"] = {query: query_embedding}
 
-    response = openai.responses.create(
-        model=MODEL,
-        instructions=SYSTEM_INSTRUCTIONS,
-        input=[{"role": "user", "content": query}],
-        tools=build_tools(state["file_ids"]),
-    )
+    # The first turn is almost always a retrieve_chunks on the user's query, so
+    # start it while the model decodes. The result lands in the session's
+    # retrieve cache, where a matching call from the model picks it up.
+    speculative = asyncio.create_task(_speculate_retrieve(query, state))
+
+    try:
+        response = await _first_response(query, state, on_delta)
+    except BaseException:
+        speculative.cancel()
+        raise
 
+    tool_turns = 0
     while True:
         tool_calls = _collect_function_calls(response)
+        if speculative is not None:
+            if any(_can_use_speculation(call) for call in tool_calls):
+                await speculative
+            else:
+                speculative.cancel()
+            speculative = None
+
         if not tool_calls:
             return response.output_text
 
-        tool_outputs = []
-        for call in tool_calls:
-            try:
-                args = json.loads(call.arguments or "{}")
-            except json.JSONDecodeError:
-                args = {}
-            try:
-                result = run_tool_call(
-                    call.name,
-                    args,
-                    morphik=morphik,
-                    openai_client=openai,
-                    state=state,
-                )
-                output = _json_dumps(result)
-            except Exception as exc:
-                output = _json_dumps({"error": str(exc)})
-
-            tool_outputs.append(
-                {
-                    "type": "function_call_output",
-                    "call_id": call.call_id,
-                    "output": output,
-                }
-            )
-
-        response = openai.responses.create(
-            model=MODEL,
-            instructions=SYSTEM_INSTRUCTIONS,
-            input=tool_outputs,
+        # Tool calls are independent network I/O, so run them concurrently.
+        # gather() keeps results in launch order.
+        tasks = [asyncio.create_task(_dispatch(call, state)) for call in tool_calls]
+        tool_outputs = await asyncio.gather(*tasks)
+
+        tool_turns += 1
+        out_of_turns = tool_turns >= MAX_TOOL_TURNS
+        response = await _stream_response(
+            on_delta,
+            tool_choice="none" if out_of_turns else "auto",
+            input=list(tool_outputs),
             previous_response_id=response.id,
             tools=build_tools(state["file_ids"]),
         )
+        if out_of_turns:
+            return response.output_text
+
+
+def _read_query_cache() -> "OrderedDict[str, Tuple[np.ndarray, str, float]]":
+    try:
+        entries = json.loads(QUERY_CACHE_PATH.read_text(encoding="utf-8")).items()
+    except (OSError, ValueError, AttributeError):
+        return OrderedDict()
+
+    cache: "OrderedDict[str, Tuple[np.ndarray, str, float]]" = OrderedDict()
+    cutoff = time.time() - QUERY_CACHE_TTL
+    for key, entry in entries:
+        try:
+            embedding = np.asarray(entry["embedding"], dtype=np.float32)
+            response_text = entry["response"]
+            created_at = float(entry["created_at"])
+        except (KeyError, TypeError, ValueError):
+            continue  # skip malformed entries rather than failing the query
+        if created_at >= cutoff and embedding.ndim == 1 and isinstance(response_text, str):
+            cache[key] = (embedding, response_text, created_at)
+    return cache
+
+
+def _write_query_cache(cache: "OrderedDict[str, Tuple[np.ndarray, str, float]]") -> None:
+    raw = {
+        key: {"embedding": embedding.tolist(), "response": response_text, "created_at": created_at}
+        for key, (embedding, response_text, created_at) in cache.items()
+    }
+    try:
+        QUERY_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = QUERY_CACHE_PATH.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(raw), encoding="utf-8")
+        os.replace(tmp_path, QUERY_CACHE_PATH)
+    except OSError:
+        pass
+
+
+def _lookup_query(
+    cache: "OrderedDict[str, Tuple[np.ndarray, str, float]]",
+    embedding: np.ndarray,
+) -> Optional[str]:
+    """Return the key of the closest cached query, if it is similar enough."""
+    keys = [key for key, entry in cache.items() if entry[0].shape == embedding.shape]
+    if not keys:
+        return None
+    similarities = np.stack([cache[key][0] for key in keys]) @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < QUERY_CACHE_MIN_SIMILARITY:
+        return None
+    return keys[best]
+
+
+def _replay_cached(
+    cache: "OrderedDict[str, Tuple[np.ndarray, str, float]]",
+    key: str,
+    on_delta: Optional[Callable[[str], None]],
+) -> str:
+    cache.move_to_end(key)
+    _write_query_cache(cache)
+    response_text = cache[key][1]
+    if on_delta is not None:
+        on_delta(response_text)
+    return response_text
+
+
+async def answer_query(query: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+    cache = _read_query_cache()
+    key = normalize_query(query)
+
+    if key in cache:
+        return _replay_cached(cache, key, on_delta)
+
+    # Embed the query while the agent's first turn is already under way, so a
+    # cache miss doesn't wait on the embedding round trip. Output is held back
+    # until the lookup misses; a hit throws away the partial first turn.
+    held: Optional[List[str]] = []
+
+    def hold_until_lookup(delta: str) -> None:
+        if held is None:
+            on_delta(delta)
+        else:
+            held.append(delta)
+
+    embedding_task = asyncio.create_task(embed_query(openai, query))
+    agent_task = asyncio.create_task(
+        run_agent(
+            query,
+            on_delta=hold_until_lookup if on_delta is not None else None,
+            query_embedding=embedding_task,
+        )
+    )
+    try:
+        # The cache is optional: if the query can't be embedded, just run the agent.
+        try:
+            embedding: Optional[np.ndarray] = await asyncio.shield(embedding_task)
+        except Exception:
+            embedding = None
+        if embedding is not None:
+            hit = _lookup_query(cache, embedding)
+            if hit is not None:
+                agent_task.cancel()
+                await asyncio.gather(agent_task, return_exceptions=True)
+                return _replay_cached(cache, hit, on_delta)
+
+        if on_delta is not None:
+            for delta in held:
+                on_delta(delta)
+        held = None
+        response_text = await agent_task
+    except BaseException:
+        agent_task.cancel()
+        embedding_task.cancel()
+        raise
+
+    if embedding is not None:
+        cache[key] = (embedding, response_text, time.time())
+        while len(cache) > QUERY_CACHE_MAXSIZE:
+            cache.popitem(last=False)
+        _write_query_cache(cache)
+    return response_text
 
 
 def main() -> None:
@@ -86,10 +392,16 @@ def main() -> None:
         print("No query provided.")
         return
 
-    response_text = run_agent(query)
+    def on_delta(delta: str) -> None:
+        sys.stdout.write(delta)
+        sys.stdout.flush()
+
+    # Text is streamed to the terminal as it arrives; response.md gets only the
+    # final answer, and only once the run has succeeded.
+    response_text = asyncio.run(answer_query(query, on_delta=on_delta))
     with open("response.md", "w", encoding="utf-8") as handle:
         handle.write(response_text)
-    print("Response saved to response.md")
+    print("\nResponse saved to response.md")
 
 
 if __name__ == "__main__":
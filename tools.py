@@ -1,135 +1,264 @@
 from __future__ import annotations
 
-import io
-from typing import Any, Dict, List, Sequence
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 from morphik import Morphik
-from openai import OpenAI
+from openai import AsyncOpenAI, NotFoundError
 
 DEFAULT_PAGE_OUTPUT_FORMAT = "url"
 DEFAULT_CHUNK_OUTPUT_FORMAT = "url"
+DEFAULT_RETRIEVE_K = 4
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+RETRIEVE_CACHE_MAXSIZE = 128
+RETRIEVE_CACHE_TTL = 300.0
+RETRIEVE_CACHE_MIN_SIMILARITY = 0.95
 
-def build_tools(file_ids: Sequence[str]) -> List[Dict[str, Any]]:
-    return [
-        {
-            "type": "function",
-            "name": "retrieve_chunks",
-            "description": (
-                "Retrieve relevant chunks from Morphik using ColPali mode. "
-                "Only provide a search query and the number of chunks to fetch."
-            ),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {"type": "string", "description": "Search query text."},
-                    "k": {"type": "integer", "description": "Number of chunks to retrieve.", "minimum": 1},
-                },
-                "required": ["query"],
+CHUNK_BATCH_SIZE = 32
+CHUNK_BATCH_CONCURRENCY = 4
+
+# Chunk content longer than this is cut to its head and tail in tool output.
+MAX_CONTENT_CHARS = 800
+
+# Uploads that outlive a single agent run, keyed by Morphik external ID.
+FILE_CACHE_PATH = Path.home() / ".cache" / "morphik-agent" / "files.json"
+_FILE_CACHE_FIELDS = ("file_id", "filename", "updated_at")
+
+
+class RawJSON:
+    """Already-serialized JSON that the agent embeds in tool output verbatim."""
+
+    __slots__ = ("json",)
+
+    def __init__(self, json: str) -> None:
+        self.json = json
+
+
+_STATIC_TOOLS: Tuple[Dict[str, Any], ...] = (
+    {
+        "type": "function",
+        "name": "retrieve_chunks",
+        "description": (
+            "Retrieve relevant chunks from Morphik using ColPali mode. "
+            "Only provide a search query and the number of chunks to fetch."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "Search query text."},
+                "k": {"type": "integer", "description": "Number of chunks to retrieve.", "minimum": 1},
             },
+            "required": ["query"],
         },
-        {
-            "type": "function",
-            "name": "get_page_range",
-            "description": (
-                "Get pages or chunks within a specific range. Provide document_id and either "
-                "start_page/end_page for page images, or start_chunk/end_chunk for chunk text."
-            ),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "document_id": {"type": "string", "description": "Morphik document external ID."},
-                    "start_page": {"type": "integer", "description": "Start page number (1-indexed)."},
-                    "end_page": {"type": "integer", "description": "End page number (1-indexed)."},
-                    "start_chunk": {"type": "integer", "description": "Start chunk number (1-indexed)."},
-                    "end_chunk": {"type": "integer", "description": "End chunk number (1-indexed)."},
-                },
-                "required": ["document_id"],
+    },
+    {
+        "type": "function",
+        "name": "get_page_range",
+        "description": (
+            "Get pages or chunks within a specific range. Provide document_id and either "
+            "start_page/end_page for page images, or start_chunk/end_chunk for chunk text."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "document_id": {"type": "string", "description": "Morphik document external ID."},
+                "start_page": {"type": "integer", "description": "Start page number (1-indexed)."},
+                "end_page": {"type": "integer", "description": "End page number (1-indexed)."},
+                "start_chunk": {"type": "integer", "description": "Start chunk number (1-indexed)."},
+                "end_chunk": {"type": "integer", "description": "End chunk number (1-indexed)."},
             },
+            "required": ["document_id"],
         },
-        {
-            "type": "function",
-            "name": "list_documents",
-            "description": "List documents available in Morphik.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "skip": {"type": "integer", "description": "Number of documents to skip.", "minimum": 0},
-                    "limit": {"type": "integer", "description": "Maximum number of documents to return.", "minimum": 1},
-                    "completed_only": {"type": "boolean", "description": "Only return completed documents."},
-                    "sort_by": {
-                        "type": "string",
-                        "description": "Field to sort by.",
-                        "enum": ["created_at", "updated_at", "filename", "external_id"],
-                    },
-                    "sort_direction": {
-                        "type": "string",
-                        "description": "Sort direction.",
-                        "enum": ["asc", "desc"],
-                    },
+    },
+    {
+        "type": "function",
+        "name": "list_documents",
+        "description": "List documents available in Morphik.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "skip": {"type": "integer", "description": "Number of documents to skip.", "minimum": 0},
+                "limit": {"type": "integer", "description": "Maximum number of documents to return.", "minimum": 1},
+                "completed_only": {"type": "boolean", "description": "Only return completed documents."},
+                "sort_by": {
+                    "type": "string",
+                    "description": "Field to sort by.",
+                    "enum": ["created_at", "updated_at", "filename", "external_id"],
+                },
+                "sort_direction": {
+                    "type": "string",
+                    "description": "Sort direction.",
+                    "enum": ["asc", "desc"],
                 },
             },
         },
-        {
-            "type": "function",
-            "name": "load_file_for_execution",
-            "description": (
-                "Load a Morphik document into the code execution environment. "
-                "Provide the document external ID."
-            ),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "document_external_id": {"type": "string", "description": "Morphik document external ID."},
-                },
-                "required": ["document_external_id"],
+    },
+    {
+        "type": "function",
+        "name": "load_file_for_execution",
+        "description": (
+            "Load a Morphik document into the code execution environment. "
+            "Provide the document external ID."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "document_external_id": {"type": "string", "description": "Morphik document external ID."},
+            },
+            "required": ["document_external_id"],
+        },
+    },
+    {
+        "type": "function",
+        "name": "get_full_chunk_content",
+        "description": (
+            "Get the full content of a single chunk. Chunk content returned by other tools is "
+            "truncated when long; use this when the truncated text is not enough."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "document_id": {"type": "string", "description": "Morphik document external ID."},
+                "chunk_number": {"type": "integer", "description": "Chunk number."},
             },
+            "required": ["document_id", "chunk_number"],
         },
+    },
+)
+
+
+def build_tools(file_ids: Sequence[str]) -> List[Dict[str, Any]]:
+    return _build_tools(frozenset(file_ids))
+
+
+@functools.lru_cache(maxsize=32)
+def _build_tools(file_ids: FrozenSet[str]) -> List[Dict[str, Any]]:
+    # Only the code interpreter container varies between turns; the function
+    # schemas are built once at import.
+    return [
+        *_STATIC_TOOLS,
         {
             "type": "code_interpreter",
             "container": {
                 "type": "auto",
                 "memory_limit": "4g",
-                "file_ids": list(file_ids),
+                "file_ids": sorted(file_ids),
             },
         },
     ]
 
 
-def run_tool_call(
+async def arun_tool_call(
     name: str,
     arguments: Dict[str, Any],
     *,
     morphik: Morphik,
-    openai_client: OpenAI,
+    openai_client: AsyncOpenAI,
+    state: Dict[str, Any],
+) -> Union[Dict[str, Any], RawJSON]:
+    try:
+        handler = _DISPATCH[name]
+    except KeyError:
+        raise ValueError(f"Unknown tool: {name}") from None
+    return await handler(morphik, openai_client, arguments, state)
+
+
+async def _retrieve_chunks(
+    morphik: Morphik,
+    openai_client: AsyncOpenAI,
+    arguments: Dict[str, Any],
     state: Dict[str, Any],
 ) -> Dict[str, Any]:
-    if name == "retrieve_chunks":
-        return _retrieve_chunks(morphik, arguments)
-    if name == "get_page_range":
-        return _get_page_range(morphik, arguments)
-    if name == "list_documents":
-        return _list_documents(morphik, arguments)
-    if name == "load_file_for_execution":
-        return _load_file_for_execution(morphik, openai_client, arguments, state)
-    raise ValueError(f"Unknown tool: {name}")
-
-
-def _retrieve_chunks(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, Any]:
     query = arguments.get("query")
     if not query:
         raise ValueError("query is required")
-    k = int(arguments.get("k") or 4)
-    chunks = morphik.retrieve_chunks(
+    k = int(arguments.get("k") or DEFAULT_RETRIEVE_K)
+
+    cache = state.setdefault("retrieve_cache", OrderedDict())
+    key = f"{k}:{normalize_query(query)}"
+    _evict_expired(cache)
+    if key in cache:
+        cache.move_to_end(key)
+        return {"query": query, "k": k, "chunks": cache[key][3], "cached": True}
+
+    # The agent may already have embedded this exact query (e.g. the user's), or
+    # still be doing so.
+    embedding = state.get("query_embeddings", {}).get(query)
+    try:
+        if isinstance(embedding, asyncio.Future):
+            embedding = await asyncio.shield(embedding)
+        if embedding is None:
+            embedding = await embed_query(openai_client, query)
+    except Exception:
+        # The cache is only an optimisation; answer from Morphik regardless.
+        embedding = None
+    if embedding is not None:
+        cached_chunks = _lookup_similar(cache, embedding, k)
+        if cached_chunks is not None:
+            return {"query": query, "k": k, "chunks": cached_chunks, "cached": True}
+
+    chunks = await asyncio.to_thread(
+        morphik.retrieve_chunks,
         query=query,
         k=k,
         use_colpali=True,
         output_format=DEFAULT_CHUNK_OUTPUT_FORMAT,
     )
-    return {"query": query, "k": k, "chunks": [_serialize_chunk(chunk) for chunk in chunks]}
+    serialized = [_serialize_chunk(chunk) for chunk in chunks]
+    cache[key] = (time.monotonic(), embedding, k, serialized)
+    while len(cache) > RETRIEVE_CACHE_MAXSIZE:
+        cache.popitem(last=False)
+    return {"query": query, "k": k, "chunks": serialized}
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
 
+async def embed_query(openai_client: AsyncOpenAI, query: str) -> np.ndarray:
+    response = await openai_client.embeddings.create(model=EMBEDDING_MODEL, input=query)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
 
-def _get_page_range(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, Any]:
+
+def _evict_expired(cache: "OrderedDict[str, tuple]") -> None:
+    cutoff = time.monotonic() - RETRIEVE_CACHE_TTL
+    for key in [key for key, entry in cache.items() if entry[0] < cutoff]:
+        del cache[key]
+
+
+def _lookup_similar(
+    cache: "OrderedDict[str, tuple]",
+    embedding: np.ndarray,
+    k: int,
+) -> Optional[List[Dict[str, Any]]]:
+    keys = [key for key, entry in cache.items() if entry[2] == k and entry[1] is not None]
+    if not keys:
+        return None
+    similarities = np.stack([cache[key][1] for key in keys]) @ embedding
+    best = int(np.argmax(similarities))
+    if similarities[best] < RETRIEVE_CACHE_MIN_SIMILARITY:
+        return None
+    cache.move_to_end(keys[best])
+    return cache[keys[best]][3]
+
+
+async def _get_page_range(
+    morphik: Morphik,
+    openai_client: AsyncOpenAI,
+    arguments: Dict[str, Any],
+    state: Dict[str, Any],
+) -> Union[Dict[str, Any], RawJSON]:
     document_id = arguments.get("document_id")
     if not document_id:
         raise ValueError("document_id is required")
@@ -139,13 +268,15 @@ def _get_page_range(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, An
     end_chunk = arguments.get("end_chunk")
 
     if start_page is not None and end_page is not None:
-        pages = morphik.extract_document_pages(
+        pages = await asyncio.to_thread(
+            morphik.extract_document_pages,
             document_id=document_id,
             start_page=int(start_page),
             end_page=int(end_page),
             output_format=DEFAULT_PAGE_OUTPUT_FORMAT,
         )
-        return {"type": "pages", **pages.model_dump()}
+        # Splice the tag into pydantic's own JSON rather than dumping to a dict.
+        return RawJSON('{"type":"pages",' + pages.model_dump_json()[1:])
 
     if start_chunk is not None and end_chunk is not None:
         start_chunk = int(start_chunk)
@@ -156,11 +287,7 @@ def _get_page_range(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, An
             {"document_id": document_id, "chunk_number": chunk_number}
             for chunk_number in range(start_chunk, end_chunk + 1)
         ]
-        chunks = morphik.batch_get_chunks(
-            sources=sources,
-            use_colpali=True,
-            output_format=DEFAULT_CHUNK_OUTPUT_FORMAT,
-        )
+        chunks = await _batch_get_chunks(morphik, sources)
         return {
             "type": "chunks",
             "document_id": document_id,
@@ -172,7 +299,31 @@ def _get_page_range(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, An
     raise ValueError("Provide start_page/end_page or start_chunk/end_chunk")
 
 
-def _list_documents(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, Any]:
+async def _batch_get_chunks(morphik: Morphik, sources: List[Dict[str, Any]]) -> List[Any]:
+    # Large ranges are split into bounded windows fetched concurrently so one
+    # huge request doesn't hold up the whole turn.
+    semaphore = asyncio.Semaphore(CHUNK_BATCH_CONCURRENCY)
+
+    async def fetch(window: List[Dict[str, Any]]) -> List[Any]:
+        async with semaphore:
+            return await asyncio.to_thread(
+                morphik.batch_get_chunks,
+                sources=window,
+                use_colpali=True,
+                output_format=DEFAULT_CHUNK_OUTPUT_FORMAT,
+            )
+
+    windows = [sources[i : i + CHUNK_BATCH_SIZE] for i in range(0, len(sources), CHUNK_BATCH_SIZE)]
+    results = await asyncio.gather(*(fetch(window) for window in windows))
+    return [chunk for window_chunks in results for chunk in window_chunks]
+
+
+async def _list_documents(
+    morphik: Morphik,
+    openai_client: AsyncOpenAI,
+    arguments: Dict[str, Any],
+    state: Dict[str, Any],
+) -> RawJSON:
     skip = int(arguments.get("skip") or 0)
     limit = int(arguments.get("limit") or 100)
     completed_only = arguments.get("completed_only", False)
@@ -180,19 +331,35 @@ def _list_documents(morphik: Morphik, arguments: Dict[str, Any]) -> Dict[str, An
         completed_only = completed_only.lower() == "true"
     sort_by = arguments.get("sort_by", "updated_at")
     sort_direction = arguments.get("sort_direction", "desc")
-    response = morphik.list_documents(
+    response = await asyncio.to_thread(
+        morphik.list_documents,
         skip=skip,
         limit=limit,
         completed_only=completed_only,
         sort_by=sort_by,
         sort_direction=sort_direction,
     )
-    return response.model_dump()
+
+    for doc in response.documents:
+        _note_document_version(state, doc.external_id, doc.system_metadata.get("updated_at"))
+
+    return RawJSON(response.model_dump_json())
 
 
-def _load_file_for_execution(
+def _note_document_version(state: Dict[str, Any], document_id: str, version: Any) -> None:
+    # Cached retrievals are stale once any document is seen at a different
+    # version than earlier in the run, whichever listing it came from. The
+    # retrieve cache only lives for one run_agent call, and newly ingested
+    # documents aren't detected here; RETRIEVE_CACHE_TTL bounds both cases.
+    versions = state.setdefault("document_versions", {})
+    if document_id in versions and versions[document_id] != version:
+        state.get("retrieve_cache", {}).clear()
+    versions[document_id] = version
+
+
+async def _load_file_for_execution(
     morphik: Morphik,
-    openai_client: OpenAI,
+    openai_client: AsyncOpenAI,
     arguments: Dict[str, Any],
     state: Dict[str, Any],
 ) -> Dict[str, Any]:
@@ -209,43 +376,193 @@ def _load_file_for_execution(
             "status": "already_loaded",
         }
 
-    document = morphik.get_document(document_id)
+    # Tool calls in a turn run concurrently; a second call for the same document
+    # waits on the first instead of downloading and uploading it again.
+    loading = state.setdefault("loading_files", {})
+    if document_id in loading:
+        result = await asyncio.shield(loading[document_id])
+        return {**result, "status": "already_loaded"}
+
+    task = loading[document_id] = asyncio.ensure_future(
+        _load_document_file(morphik, openai_client, document_id, state)
+    )
+    try:
+        return await asyncio.shield(task)
+    finally:
+        del loading[document_id]
+
+
+async def _load_document_file(
+    morphik: Morphik,
+    openai_client: AsyncOpenAI,
+    document_id: str,
+    state: Dict[str, Any],
+) -> Dict[str, Any]:
+    document = await asyncio.to_thread(morphik.get_document, document_id)
     filename = document.filename or f"{document_id}"
-    file_bytes = morphik.get_document_file(document_id)
+    version = str(document.system_metadata.get("updated_at") or "")
+    _note_document_version(state, document_id, document.system_metadata.get("updated_at"))
+
+    file_cache = _read_file_cache()
+    cached = file_cache.get(document_id)
+    # On a cache hit the container holds the file under the name it was uploaded
+    # with, which a later rename in Morphik doesn't change.
+    if cached and version and cached.get("updated_at") == version:
+        if await _openai_file_exists(openai_client, cached["file_id"]):
+            return _record_loaded_file(
+                state, document_id, cached["file_id"], cached["filename"], "loaded_from_cache"
+            )
+
+    file_bytes = await asyncio.to_thread(morphik.get_document_file, document_id)
+    sha256 = hashlib.sha256(file_bytes).hexdigest()
+
+    # Same content under a newer updated_at (e.g. metadata edits): skip the upload.
+    if cached and cached.get("sha256") == sha256:
+        if await _openai_file_exists(openai_client, cached["file_id"]):
+            result = _record_loaded_file(
+                state, document_id, cached["file_id"], cached["filename"], "loaded_from_cache"
+            )
+            _write_file_cache_entry(document_id, {**cached, "updated_at": version})
+            return result
 
-    file_buffer = io.BytesIO(file_bytes)
-    file_buffer.seek(0)
-    file_obj = openai_client.files.create(
-        file=(filename, file_buffer),
+    # Hand the downloaded bytes over as-is; wrapping them in a buffer would only
+    # add a copy.
+    file_obj = await openai_client.files.create(
+        file=(filename, file_bytes),
         purpose="assistants",
     )
 
-    state.setdefault("file_ids", set()).add(file_obj.id)
-    loaded_files[document_id] = {"file_id": file_obj.id, "filename": filename}
+    # Record the upload before touching the cache file so a failed write can't
+    # cost the run a file it has already paid for.
+    result = _record_loaded_file(state, document_id, file_obj.id, filename, "loaded")
+    _write_file_cache_entry(
+        document_id,
+        {
+            "sha256": sha256,
+            "updated_at": version,
+            "file_id": file_obj.id,
+            "filename": filename,
+            "uploaded_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+    return result
 
+
+def _record_loaded_file(
+    state: Dict[str, Any],
+    document_id: str,
+    file_id: str,
+    filename: str,
+    status: str,
+) -> Dict[str, Any]:
+    state.setdefault("file_ids", set()).add(file_id)
+    state.setdefault("loaded_files", {})[document_id] = {"file_id": file_id, "filename": filename}
     return {
         "document_id": document_id,
-        "file_id": file_obj.id,
+        "file_id": file_id,
         "filename": filename,
-        "status": "loaded",
+        "status": status,
     }
 
 
-def _serialize_chunk(chunk: Any) -> Dict[str, Any]:
-    content = chunk.content
-    if not isinstance(content, str):
+async def _openai_file_exists(openai_client: AsyncOpenAI, file_id: str) -> bool:
+    try:
+        await openai_client.files.retrieve(file_id)
+    except NotFoundError:
+        return False
+    return True
+
+
+def _read_file_cache() -> Dict[str, Dict[str, Any]]:
+    try:
+        raw = json.loads(FILE_CACHE_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(raw, dict):
+        return {}
+    # Drop anything a hand edit or an older layout left behind.
+    return {
+        document_id: entry
+        for document_id, entry in raw.items()
+        if isinstance(entry, dict)
+        and all(isinstance(entry.get(field), str) for field in _FILE_CACHE_FIELDS)
+    }
+
+
+def _write_file_cache_entry(document_id: str, entry: Dict[str, Any]) -> None:
+    file_cache = _read_file_cache()
+    file_cache[document_id] = entry
+    try:
+        FILE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = FILE_CACHE_PATH.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(file_cache, indent=2), encoding="utf-8")
+        os.replace(tmp_path, FILE_CACHE_PATH)
+    except OSError:
+        # The cache only saves re-uploads; the file is already loaded for this run.
+        pass
+
+
+async def _get_full_chunk_content(
+    morphik: Morphik,
+    openai_client: AsyncOpenAI,
+    arguments: Dict[str, Any],
+    state: Dict[str, Any],
+) -> Dict[str, Any]:
+    document_id = arguments.get("document_id")
+    if not document_id:
+        raise ValueError("document_id is required")
+    chunk_number = arguments.get("chunk_number")
+    if chunk_number is None:
+        raise ValueError("chunk_number is required")
+    chunk_number = int(chunk_number)
+
+    chunks = await asyncio.to_thread(
+        morphik.batch_get_chunks,
+        sources=[{"document_id": document_id, "chunk_number": chunk_number}],
+        use_colpali=True,
+        output_format=DEFAULT_CHUNK_OUTPUT_FORMAT,
+    )
+    if not chunks:
+        raise ValueError(f"Chunk {chunk_number} not found in document {document_id}")
+    return _serialize_chunk(chunks[0], max_chars=None)
+
+
+# Every handler takes (morphik, openai_client, arguments, state).
+_DISPATCH: Dict[str, Callable[..., Awaitable[Any]]] = {
+    "retrieve_chunks": _retrieve_chunks,
+    "get_page_range": _get_page_range,
+    "list_documents": _list_documents,
+    "load_file_for_execution": _load_file_for_execution,
+    "get_full_chunk_content": _get_full_chunk_content,
+}
+
+
+def _serialize_chunk(chunk: Any, max_chars: Optional[int] = MAX_CONTENT_CHARS) -> Dict[str, Any]:
+    # Read the pydantic field values straight from the instance dict.
+    fields = chunk.__dict__
+    content = fields["content"]
+    if type(content) is not str:
         if hasattr(content, "size"):
             content = f"<image size={getattr(content, 'size', '')}>"
         else:
             content = str(content)
 
-    return {
-        "document_id": chunk.document_id,
-        "chunk_number": chunk.chunk_number,
-        "score": chunk.score,
+    serialized = {
+        "document_id": fields["document_id"],
+        "chunk_number": fields["chunk_number"],
+        "score": fields["score"],
         "content": content,
-        "metadata": chunk.metadata,
-        "content_type": chunk.content_type,
-        "filename": chunk.filename,
-        "download_url": chunk.download_url,
+        "metadata": fields["metadata"],
+        "content_type": fields["content_type"],
     }
+    # Optional fields are only emitted when set.
+    if fields["filename"] is not None:
+        serialized["filename"] = fields["filename"]
+    if fields["download_url"] is not None:
+        serialized["download_url"] = fields["download_url"]
+    if max_chars is not None and len(content) > max_chars:
+        half = max_chars // 2
+        serialized["content"] = f"{content[:half]}…{content[-half:]}"
+        serialized["content_sha1"] = hashlib.sha1(content.encode("utf-8")).hexdigest()[:10]
+        serialized["content_len"] = len(content)
+    return serialized